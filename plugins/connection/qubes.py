@@ -48,11 +48,48 @@ DOCUMENTATION = """
         default: user
         vars:
             - name: ansible_user
+      persistent_session:
+        description:
+            - Keep a single qrexec shell session open for the lifetime of the
+              connection and run commands that do not send data on stdin
+              through it, instead of spawning a new qvm-run for each of them.
+        type: bool
+        default: false
+        vars:
+            - name: ansible_qubes_persistent_session
+      batch_put:
+        description:
+            - Defer the transfer of small files to the qube and send them
+              along with the next command, saving one qvm-run invocation per
+              file (e.g. for every module copied to the qube).
+        type: bool
+        default: false
+        vars:
+            - name: ansible_qubes_batch_put
+      compress_put:
+        description:
+            - Compress the files sent by put_file with gzip in dom0 and
+              decompress them in the qube, which requires gzip in the qube.
+              This speeds up the transfer of large compressible files.
+        type: bool
+        default: false
+        vars:
+            - name: ansible_qubes_compress_put
 """
 
+import base64
+import concurrent.futures
+import errno
+import fcntl
+import gzip
+import os
+import selectors
+import shlex
+import shutil
 import subprocess
+import uuid
 
-from ansible.module_utils.common.text.converters import to_bytes
+from ansible.module_utils.common.text.converters import to_bytes, to_text
 from ansible.plugins.connection import ConnectionBase, ensure_connect
 
 try:
@@ -62,6 +99,151 @@ except ImportError:
 
     display = Display()
 
+# Resolved once so that spawning qvm-run does not search PATH every time
+QVM_RUN = shutil.which("qvm-run") or "qvm-run"
+# Buffer size used for the qvm-run pipes and when streaming file contents
+COPY_BUFSIZE = 1024 * 1024
+# Bounds of the buffer sizes picked according to the size of a transfer
+MIN_BUFSIZE = 64 * 1024
+MAX_BUFSIZE = 8 * 1024 * 1024
+# Initial buffer size of fetch_file(), grown while the reads fill it up
+FETCH_BUFSIZE = 256 * 1024
+# Maximum amount of data moved by a single os.sendfile() call
+SENDFILE_BLOCKSIZE = 16 * 1024 * 1024
+# Maximum size of a file whose transfer can be batched with the next command
+BATCH_PUT_MAXSIZE = 1024 * 1024
+# Fetched files at least this large are dropped from the page cache
+DROP_CACHE_MINSIZE = 64 * 1024 * 1024
+# Delimiter of the batched file contents, out of the base64 alphabet
+BATCH_PUT_EOF = "__ANSIBLE_PUT_EOF__"
+# Reported on stderr when writing a batched file failed
+BATCH_PUT_FAILED = "__ANSIBLE_PUT_FAILED__"
+# Reported on stderr when decompressing a transferred file failed, as the
+# exit status of the pipeline is the one of dd
+GUNZIP_FAILED = "__ANSIBLE_GUNZIP_FAILED__"
+
+
+def _grow_pipe(pipe):
+    """
+    Enlarge the kernel buffer of a pipe to COPY_BUFSIZE where supported.
+    """
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, COPY_BUFSIZE)
+    except (AttributeError, OSError):
+        # Not Linux, or above the limit set in /proc/sys/fs/pipe-max-size
+        pass
+
+
+def _buffer_size(size):
+    """
+    Pick a buffer size matching the size of a transfer, within bounds.
+    """
+    return max(MIN_BUFSIZE, min(MAX_BUFSIZE, size))
+
+
+def _send_file(fobj, pipe, bufsize=COPY_BUFSIZE):
+    """
+    Copy the contents of a file object to a pipe, in kernel space with
+    os.sendfile() where supported and through Python otherwise.
+    """
+    pipe.flush()
+    offset = fobj.tell()
+    if hasattr(os, "sendfile"):
+        try:
+            while True:
+                sent = os.sendfile(
+                    pipe.fileno(), fobj.fileno(), offset, SENDFILE_BLOCKSIZE
+                )
+                if not sent:
+                    return
+                offset += sent
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+        fobj.seek(offset)
+    shutil.copyfileobj(fobj, pipe, bufsize)
+
+
+def _write_input(pipe, cmd, in_data, compress=False, bufsize=COPY_BUFSIZE):
+    """
+    Write a command and its input data to a pipe, then close it.
+
+    The command and the data are written separately rather than
+    concatenated, and file objects are streamed so that memory usage stays
+    bounded. With compress, file objects are streamed through gzip.
+    """
+    try:
+        with pipe:
+            pipe.write(cmd)
+            if isinstance(in_data, bytes):
+                pipe.write(in_data)
+            elif compress:
+                with gzip.GzipFile(
+                    fileobj=pipe, mode="wb", compresslevel=1
+                ) as gzip_pipe:
+                    shutil.copyfileobj(in_data, gzip_pipe, bufsize)
+            elif in_data is not None:
+                _send_file(in_data, pipe, bufsize)
+    except BrokenPipeError:
+        # The remote side exited early, its status is reported by qvm-run
+        pass
+
+
+def _read_pipes(stdout, stderr):
+    """
+    Read two pipes until end of file, concurrently so that neither of them
+    can fill up and block the writing process.
+
+    :return: Tuple of (stdout, stderr) contents.
+    """
+    out = bytearray()
+    err = bytearray()
+    with selectors.DefaultSelector() as selector:
+        selector.register(stdout, selectors.EVENT_READ, out)
+        selector.register(stderr, selectors.EVENT_READ, err)
+        while selector.get_map():
+            for key, _ in selector.select():
+                chunk = os.read(key.fd, COPY_BUFSIZE)
+                if chunk:
+                    key.data.extend(chunk)
+                else:
+                    selector.unregister(key.fileobj)
+    return bytes(out), bytes(err)
+
+
+def _copy_from_pipe(pipe, fobj):
+    """
+    Copy the contents of a pipe to an unbuffered file object through a
+    preallocated buffer, doubled up to MAX_BUFSIZE whenever a read fills it.
+
+    :return: Number of bytes copied.
+    """
+    buf = bytearray(FETCH_BUFSIZE)
+    view = memoryview(buf)
+    total = 0
+    while True:
+        size = pipe.readinto(buf)
+        if not size:
+            return total
+        total += size
+        # Raw file objects may write less than requested
+        written = 0
+        while written < size:
+            written += fobj.write(view[written:size])
+        if size == len(buf) and size < MAX_BUFSIZE:
+            buf = bytearray(size * 2)
+            view = memoryview(buf)
+
+
+def _drop_cache(fobj):
+    """
+    Flush the data of a file to disk and evict it from the page cache, so
+    that bulk copies do not push out pages that are actually in use.
+    """
+    os.fdatasync(fobj.fileno())
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fobj.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
 
 class Connection(ConnectionBase):
     """
@@ -84,58 +266,202 @@ class Connection(ConnectionBase):
             if self._play_context.remote_user
             else "user"
         )
-
-    def _qubes(self, cmd: str, in_data: bytes = None):
-        """
-        Execute a command in the qube via qvm-run.
-
-        :param cmd: Command string to execute on the remote system.
-        :param in_data: Additional data to pass to the remote command's stdin.
-        :param shell: Service type (e.g. qubes.VMShell or qubes.VMRootShell).
-        :return: Tuple of (returncode, stdout, stderr).
-        """
-        display.vvvv(f"CMD: {cmd}")
-        if not cmd.endswith("\n"):
-            cmd += "\n"
-
-        local_cmd = ["qvm-run", "--pass-io", "--service", self._remote_vmname]
+        # The qube and the user do not change during the connection, so the
+        # qvm-run command line is only built once
+        local_cmd = [QVM_RUN, "--pass-io", "--service", self._remote_vmname]
         # The Ansible module framework catches invalid remote_user values
         if self.user == "root":
             local_cmd.append("qubes.VMRootShell")
         else:
             local_cmd.append("qubes.VMShell")
-        local_cmd_bytes = [
+        self._local_cmd_bytes = [
             to_bytes(arg, errors="surrogate_or_strict") for arg in local_cmd
         ]
-        display.vvvv(f"Local cmd: {local_cmd_bytes}")
-        display.vvv(f"RUN {local_cmd_bytes}", host=self._remote_vmname)
+        self._persistent = False
+        self._session = None
+        self._batch_put = False
+        self._compress_put = False
+        self._pending_puts = []
+
+    def _local_cmd(self):
+        """
+        Return the qvm-run command line starting a shell in the qube.
+
+        :return: List of arguments as bytes.
+        """
+        # Skip formatting the messages when they would not be displayed
+        if display.verbosity >= 4:
+            display.vvvv(f"Local cmd: {self._local_cmd_bytes}")
+        if display.verbosity >= 3:
+            display.vvv(
+                f"RUN {self._local_cmd_bytes}", host=self._remote_vmname
+            )
+        return self._local_cmd_bytes
 
-        # Combine the command and any additional input data
-        combined_input = to_bytes(cmd, errors="surrogate_or_strict")
-        if in_data:
-            combined_input += in_data
+    def _qubes(self, cmd, in_data=None, compress=False, bufsize=COPY_BUFSIZE):
+        """
+        Execute a command in the qube via qvm-run.
+
+        :param cmd: Command to execute on the remote system, as str or bytes.
+        :param in_data: Additional data to pass to the remote command's stdin,
+            either as bytes or as a binary file object to stream from.
+        :param compress: Whether to gzip the data streamed from a file object.
+        :param bufsize: Size of the buffers used to write the input data.
+        :return: Tuple of (returncode, stdout, stderr).
+        """
+        if display.verbosity >= 4:
+            display.vvvv(f"CMD: {cmd}")
+        # Commands already given as bytes are passed through unchanged
+        if not isinstance(cmd, (bytes, bytearray)):
+            cmd = to_bytes(cmd, errors="surrogate_or_strict")
+        if not cmd.endswith(b"\n"):
+            cmd += b"\n"
 
         try:
-            result = subprocess.run(
-                local_cmd_bytes,
-                input=combined_input,
+            proc = subprocess.Popen(
+                self._local_cmd(),
+                stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                check=False,
+                bufsize=bufsize,
             )
         except Exception as e:
             display.error(f"Error executing command via qvm-run: {e}")
             raise
 
-        return result.returncode, result.stdout, result.stderr
+        # Feed stdin from another thread while reading both stdout and
+        # stderr, so that none of the pipes can fill up and stall qvm-run
+        with proc, concurrent.futures.ThreadPoolExecutor(1) as executor:
+            feeding = executor.submit(
+                _write_input, proc.stdin, cmd, in_data, compress, bufsize
+            )
+            stdout, stderr = _read_pipes(proc.stdout, proc.stderr)
+            feeding.result()
+
+        return proc.returncode, stdout, stderr
+
+    def _session_exec(self, cmd):
+        """
+        Execute a command through the persistent shell session of the qube,
+        starting the session first if needed.
+
+        The command reads its stdin from /dev/null and the end of its output
+        is delimited on both stdout and stderr by a unique marker, preceded
+        on stdout by the exit status of the command.
+
+        :param cmd: Command to execute on the remote system, as str or bytes.
+        :return: Tuple of (returncode, stdout, stderr).
+        """
+        if display.verbosity >= 4:
+            display.vvvv(f"SESSION CMD: {cmd}")
+        cmd = to_text(cmd, errors="surrogate_or_strict")
+        if self._session is None or self._session.poll() is not None:
+            try:
+                self._session = subprocess.Popen(
+                    self._local_cmd(),
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    bufsize=0,
+                )
+            except Exception as e:
+                display.error(f"Error executing command via qvm-run: {e}")
+                raise
+
+        marker = f"__ANSIBLE_DONE_{uuid.uuid4().hex}__"
+        script = (
+            f"/bin/sh -c {shlex.quote(cmd)} </dev/null\n"
+            f"printf '\\n%d %s\\n' $? {marker}\n"
+            f"printf '\\n%s\\n' {marker} >&2\n"
+        )
+        out_end = to_bytes(f" {marker}\n")
+        err_end = to_bytes(f"\n{marker}\n")
+        out = bytearray()
+        err = bytearray()
+
+        try:
+            self._session.stdin.write(
+                to_bytes(script, errors="surrogate_or_strict")
+            )
+        except BrokenPipeError:
+            self._close_session()
+            raise RuntimeError(
+                f"Persistent session to {self._remote_vmname} was closed"
+            )
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._session.stdout, selectors.EVENT_READ, out)
+            selector.register(self._session.stderr, selectors.EVENT_READ, err)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    chunk = os.read(key.fd, COPY_BUFSIZE)
+                    if not chunk:
+                        self._close_session()
+                        raise RuntimeError(
+                            f"Persistent session to {self._remote_vmname} "
+                            "was closed"
+                        )
+                    key.data.extend(chunk)
+                    end = out_end if key.data is out else err_end
+                    if key.data.endswith(end):
+                        selector.unregister(key.fileobj)
+
+        stdout, _, status = bytes(out[: -len(out_end)]).rpartition(b"\n")
+        return int(status), stdout, bytes(err[: -len(err_end)])
+
+    def _close_session(self):
+        """
+        Terminate the persistent shell session of the qube, if any.
+        """
+        session, self._session = self._session, None
+        if session is None:
+            return
+        with session:
+            try:
+                # The remote shell exits once its stdin is closed
+                session.stdin.close()
+                session.wait(timeout=10)
+            except (BrokenPipeError, subprocess.TimeoutExpired):
+                session.kill()
 
     def _connect(self):
         """
-        Establish the connection (no persistent connection is maintained).
+        Establish the connection. With the persistent_session option, the
+        shell session of the qube is started on the first command.
         """
         super(Connection, self)._connect()
+        self._persistent = self.get_option("persistent_session")
+        self._batch_put = self.get_option("batch_put")
+        self._compress_put = self.get_option("compress_put")
         self._connected = True
 
+    def _batched_puts(self):
+        """
+        Build a shell snippet writing the pending files to the qube and
+        clear them, so that they are transferred along with a command.
+
+        :return: Tuple of (snippet, destination paths).
+        """
+        script = ""
+        paths = []
+        for out_path, data in self._pending_puts:
+            quoted_path = shlex.quote(out_path)
+            script += (
+                f"base64 -d > {quoted_path} <<'{BATCH_PUT_EOF}' || "
+                f"{{ echo {BATCH_PUT_FAILED} >&2; exit 1; }}\n"
+                f"{base64.encodebytes(data).decode()}{BATCH_PUT_EOF}\n"
+            )
+            paths.append(out_path)
+        self._pending_puts = []
+        return script, paths
+
+    def _flush_puts(self):
+        """
+        Transfer the pending files to the qube, if any.
+        """
+        if self._pending_puts:
+            self.exec_command("true")
+
     @ensure_connect
     def exec_command(self, cmd, in_data=None, sudoable=False):
         """
@@ -146,23 +472,55 @@ class Connection(ConnectionBase):
         :param sudoable: Not used in this plugin.
         :return: Tuple (returncode, stdout, stderr).
         """
-        display.vvvv(f"CMD IS: {cmd}")
-        rc, stdout, stderr = self._qubes(cmd, in_data)
-        display.vvvvv(
-            f"STDOUT {stdout!r} STDERR {stderr!r}", host=self._remote_vmname
-        )
+        if display.verbosity >= 4:
+            display.vvvv(f"CMD IS: {cmd}")
+        puts_script, put_paths = self._batched_puts()
+        if puts_script:
+            cmd = to_bytes(puts_script) + to_bytes(
+                cmd, errors="surrogate_or_strict"
+            )
+        # The session passes the command to sh -c as a single argument,
+        # which batched files would push past the kernel's per-argument
+        # limit, whereas qvm-run writes it to the shell's stdin
+        if self._persistent and in_data is None and not puts_script:
+            rc, stdout, stderr = self._session_exec(cmd)
+        else:
+            rc, stdout, stderr = self._qubes(cmd, in_data)
+        if display.verbosity >= 5:
+            display.vvvvv(
+                f"STDOUT {stdout!r} STDERR {stderr!r}",
+                host=self._remote_vmname,
+            )
+        if put_paths and to_bytes(BATCH_PUT_FAILED) in stderr:
+            raise RuntimeError(f"Failed to put_file to {', '.join(put_paths)}")
         return rc, stdout, stderr
 
+    @ensure_connect
     def put_file(self, in_path, out_path):
         """
         Copy a local file from 'in_path' to the remote VM at 'out_path'.
+        With the batch_put option, small files are only sent with the next
+        command.
         """
         display.vvv(f"PUT {in_path} TO {out_path}", host=self._remote_vmname)
         with open(in_path, "rb") as fobj:
-            source_data = fobj.read()
-
-        retcode, _, _ = self._qubes(f'cat > "{out_path}"\n', source_data)
-        if retcode != 0:
+            size = os.fstat(fobj.fileno()).st_size
+            if self._batch_put and size <= BATCH_PUT_MAXSIZE:
+                # The local file may be removed as soon as we return
+                self._pending_puts.append((out_path, fobj.read()))
+                return
+            # Keep the transfers in order, and report failures of the queued
+            # ones here rather than with an unrelated later command
+            self._flush_puts()
+            bufsize = _buffer_size(size)
+            cmd = f"dd bs={bufsize} status=none of={shlex.quote(out_path)}"
+            if self._compress_put:
+                # Not every shell of the qube supports set -o pipefail
+                cmd = f"{{ gunzip -c || echo {GUNZIP_FAILED} >&2; }} | {cmd}"
+            retcode, _, stderr = self._qubes(
+                cmd, fobj, compress=self._compress_put, bufsize=bufsize
+            )
+        if retcode != 0 or to_bytes(GUNZIP_FAILED) in stderr:
             raise RuntimeError(f"Failed to put_file to {out_path}")
 
     def fetch_file(self, in_path, out_path):
@@ -170,20 +528,29 @@ class Connection(ConnectionBase):
         Retrieve a file from the remote VM located at 'in_path' and save it to 'out_path'.
         """
         display.vvv(f"FETCH {in_path} TO {out_path}", host=self._remote_vmname)
+        self._flush_puts()
         cmd_args = [
-            "qvm-run",
+            QVM_RUN,
             "--pass-io",
             self._remote_vmname,
-            f"cat {in_path}",
+            f"dd bs={COPY_BUFSIZE} status=none if={shlex.quote(in_path)}",
         ]
-        with open(out_path, "wb") as fobj:
-            result = subprocess.run(cmd_args, stdout=fobj)
-        if result.returncode != 0:
+        with open(out_path, "wb", buffering=0) as fobj:
+            proc = subprocess.Popen(cmd_args, stdout=subprocess.PIPE, bufsize=0)
+            _grow_pipe(proc.stdout)
+            with proc:
+                size = _copy_from_pipe(proc.stdout, fobj)
+            if proc.returncode == 0 and size >= DROP_CACHE_MINSIZE:
+                _drop_cache(fobj)
+        if proc.returncode != 0:
             raise RuntimeError(f"Failed to fetch file to {out_path}")
 
     def close(self):
         """
         Close the connection.
         """
+        if self._connected:
+            self._flush_puts()
+        self._close_session()
         super(Connection, self).close()
         self._connected = False
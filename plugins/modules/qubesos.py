@@ -42,6 +42,7 @@ options:
     description:
       - Name of the Qubes OS virtual machine to manage.
       - This parameter is required for operations targeting a specific VM. It can also be specified as C(guest).
+      - A non-empty list of names applies the same task to each of those VMs, returning the per-VM results under C(results). If the task fails for one of them, the results of the VMs handled before it are returned as well.
   state:
     description:
       - Desired state of the VM.
@@ -151,6 +152,7 @@ author:
 
 import time
 import traceback
+from functools import cache, cached_property
 
 try:
     import qubesadmin
@@ -169,6 +171,9 @@ except ImportError:
     QubesVMNotStartedError = None
     QubesTagNotFoundError = None
     QubesVMError = None
+    VirtualDevice = None
+    DeviceAssignment = None
+    ProtocolError = None
 
 
 from jinja2 import Template
@@ -224,12 +229,26 @@ PROPS = {
     "volume": dict,
 }
 
-
-def create_inventory(result):
-    """
-    Creates the inventory file dynamically for QubesOS
-    """
-    template_str = """[local]
+# Properties set as-is by QubesVirt.properties(), in the order they apply
+VM_PROPS = (
+    "autostart",
+    "debug",
+    "include_in_backups",
+    "kernel",
+    "label",
+    "maxmem",
+    "memory",
+    "provides_network",
+    "netvm",
+    "default_dispvm",
+    "template",
+    "template_for_dispvms",
+    "vcpus",
+    "virt_mode",
+)
+
+
+INVENTORY_TEMPLATE = """[local]
 localhost
 
 [local:vars]
@@ -265,10 +284,22 @@ ansible_connection=qubes
 ansible_connection=qubes
 {% endif %}
 """
-    template = Template(template_str)
-    res = template.render(result=result)
+
+
+@cache
+def inventory_template():
+    """
+    Compile the inventory template on first use only
+    """
+    return Template(INVENTORY_TEMPLATE)
+
+
+def create_inventory(result):
+    """
+    Creates the inventory file dynamically for QubesOS
+    """
     with open("inventory", "w") as fobj:
-        fobj.write(res)
+        inventory_template().stream(result=result).dump(fobj)
 
 
 class QubesVirt(object):
@@ -276,51 +307,77 @@ class QubesVirt(object):
     def __init__(self, module):
         self.module = module
         self.app = qubesadmin.Qubes()
+        # qubes looked up by the property resolvers, by name
+        self._resolved_vms = {}
+        # netvm and default_dispvm qubes that passed the properties checks,
+        # by (property, name), for the next qubes of a list of names
+        self.validated_vms = {}
+
+    @cached_property
+    def device_classes(self):
+        """All available device classes in dom0 (excluding 'testclass')."""
+        return frozenset(
+            c for c in self.app.list_deviceclass() if c != "testclass"
+        )
 
-    def get_device_classes(self):
-        """List all available device classes in dom0 (excluding 'testclass')."""
-        return [c for c in self.app.list_deviceclass() if c != "testclass"]
+    def find_devices_of_classes(self, *klasses):
+        """Map each class to the port IDs of the matching devices in dom0.
 
-    def find_devices_of_class(self, klass):
-        """Yield the port IDs of all devices matching a given class in dom0."""
+        The PCI devices are listed, and their interfaces read, only once.
+        """
+        found = {klass: [] for klass in klasses}
         for dev in self.app.domains["dom0"].devices["pci"]:
-            if repr(dev.interfaces[0]).startswith("p" + klass):
-                yield dev.port_id
+            iface = repr(dev.interfaces[0])
+            for klass in klasses:
+                if iface.startswith("p" + klass):
+                    found[klass].append(dev.port_id)
+        return found
 
     def get_vm(self, vmname):
         """Retrieve a qube object by its name."""
         return self.app.domains[vmname]
 
-    def __get_state(self, vmname):
-        """Determine the current power state of a qube."""
-        vm = self.app.domains[vmname]
-        if vm.is_paused():
+    def __get_state(self, vm):
+        """Determine the current power state of a qube object."""
+        # One call, where is_paused/is_running/is_halted would make three
+        power_state = vm.get_power_state()
+        if power_state == "Paused":
             return "paused"
-        if vm.is_running():
+        if power_state == "Running":
             return "running"
-        if vm.is_halted():
+        if power_state == "Halted":
             return "shutdown"
         return None
 
+    @cached_property
+    def all_domains(self):
+        """All qubes, listed once with qubesadmin's property cache turned on.
+
+        With the cache on, qubesadmin reads the power state of every qube from
+        the domain listing and fetches all properties of a qube in a single
+        call, instead of one call per property. Only the read-only host
+        commands use this.
+        """
+        if hasattr(self.app, "cache_enabled"):
+            self.app.cache_enabled = True
+        return tuple(self.app.domains)
+
     def get_states(self):
         """Get the names and states of all qubes."""
-        state = []
-        for vm in self.app.domains:
-            state.append(f"{vm.name} {self.__get_state(vm.name)}")
-        return state
+        return [f"{vm.name} {self.__get_state(vm)}" for vm in self.all_domains]
 
     def list_vms(self, state):
         """List all non-dom0 qubes that match a specified state."""
-        res = []
-        for vm in self.app.domains:
-            if vm.name != "dom0" and state == self.__get_state(vm.name):
-                res.append(vm.name)
-        return res
+        return [
+            vm.name
+            for vm in self.all_domains
+            if vm.name != "dom0" and state == self.__get_state(vm)
+        ]
 
     def all_vms(self):
         """Group all non-dom0 qubes by their VM class."""
         res = {}
-        for vm in self.app.domains:
+        for vm in self.all_domains:
             if vm.name == "dom0":
                 continue
             res.setdefault(vm.klass, []).append(vm.name)
@@ -328,16 +385,17 @@ class QubesVirt(object):
 
     def info(self):
         """Gather detailed info (state, network, label) for all non-dom0 qubes."""
-        info = {}
-        for vm in self.app.domains:
-            if vm.name == "dom0":
-                continue
-            info[vm.name] = {
-                "state": self.__get_state(vm.name),
+        # With the property cache on, each qube costs at most one qubesd call,
+        # so the qubes are walked in turn on the shared app
+        return {
+            vm.name: {
+                "state": self.__get_state(vm),
                 "provides_network": vm.provides_network,
                 "label": vm.label.name,
             }
-        return info
+            for vm in self.all_domains
+            if vm.name != "dom0"
+        }
 
     def shutdown(self, vmname, wait=False):
         """
@@ -390,10 +448,15 @@ class QubesVirt(object):
         template=None,
         netvm="*default*",
     ):
-        """Create a new qube of the given type, label, template, and network."""
+        """Create a new qube of the given type, label, template, and network.
+
+        Returns the new qube, or None if the type and template do not allow
+        one to be created.
+        """
+        vm = None
         template_vm = template or ""
         if netvm == "*default*":
-            network_vm = self.app.default_netvm
+            network_vm = self.default_netvm
         elif not netvm:
             network_vm = None
         else:
@@ -406,7 +469,25 @@ class QubesVirt(object):
         elif vmtype in ["StandaloneVM", "TemplateVM"] and template_vm:
             vm = self.app.clone_vm(template_vm, vmname, vmtype)
             vm.label = label
-        return 0
+        return vm
+
+    def ensure_present(
+        self,
+        vmname,
+        vmtype="AppVM",
+        label="red",
+        template=None,
+        netvm="*default*",
+    ):
+        """Return a qube and whether it was just created, creating it if missing."""
+        try:
+            return self.get_vm(vmname), False
+        except KeyError:
+            pass
+        vm = self.create(vmname, vmtype, label, template, netvm)
+        if vm is None:
+            vm = self.get_vm(vmname)
+        return vm, True
 
     def start(self, vmname):
         """Start the specified qube via the given id or name"""
@@ -420,92 +501,50 @@ class QubesVirt(object):
         vm.kill()
         return 0
 
+    @cached_property
+    def default_netvm(self):
+        """The system-wide default netvm."""
+        return self.app.default_netvm
+
+    def __resolve_vm(self, vmname):
+        """Resolve a qube-valued property to a qube, remembering the result."""
+        if vmname not in self._resolved_vms:
+            self._resolved_vms[vmname] = self.get_vm(vmname)
+        return self._resolved_vms[vmname]
+
+    def __resolve_netvm(self, netvm):
+        """Resolve the requested netvm of a qube to a qube object."""
+        # To make sure that we allow VMs with netvm
+        if netvm == "":
+            return ""
+        if netvm == "*default*":
+            return self.default_netvm
+        return self.__resolve_vm(netvm)
+
     def properties(self, vmname, prefs, vmtype, label, vmtemplate):
         """Sets the given properties to the qube"""
         changed = False
         values_changed = []
-        try:
-            vm = self.get_vm(vmname)
-        except KeyError:
-            self.create(vmname, vmtype, label, vmtemplate)
-            vm = self.get_vm(vmname)
-        if "autostart" in prefs and vm.autostart != prefs["autostart"]:
-            vm.autostart = prefs["autostart"]
-            changed = True
-            values_changed.append("autostart")
-        if "debug" in prefs and vm.debug != prefs["debug"]:
-            vm.debug = prefs["debug"]
-            changed = True
-            values_changed.append("debug")
-        if (
-            "include_in_backups" in prefs
-            and vm.include_in_backups != prefs["include_in_backups"]
-        ):
-            vm.include_in_backups = prefs["include_in_backups"]
-            changed = True
-            values_changed.append("include_in_backups")
-        if "kernel" in prefs and vm.kernel != prefs["kernel"]:
-            vm.kernel = prefs["kernel"]
-            changed = True
-            values_changed.append("kernel")
-        if "label" in prefs and vm.label.name != prefs["label"]:
-            vm.label = prefs["label"]
-            changed = True
-            values_changed.append("label")
-        if "maxmem" in prefs and vm.maxmem != prefs["maxmem"]:
-            vm.maxmem = prefs["maxmem"]
-            changed = True
-            values_changed.append("maxmem")
-        if "memory" in prefs and vm.memory != prefs["memory"]:
-            vm.memory = prefs["memory"]
-            changed = True
-            values_changed.append("memory")
-        if (
-            "provides_network" in prefs
-            and vm.provides_network != prefs["provides_network"]
-        ):
-            vm.provides_network = prefs["provides_network"]
-            changed = True
-            values_changed.append("provides_network")
-        if "netvm" in prefs:
-            # To make sure that we allow VMs with netvm
-            if prefs["netvm"] == "":
-                netvm = ""
-            elif prefs["netvm"] == "*default*":
-                netvm = self.app.default_netvm
-            else:
-                netvm = self.app.domains[prefs["netvm"]]
-            if vm.netvm != netvm:
-                vm.netvm = netvm
-                changed = True
-                values_changed.append("netvm")
-        if "default_dispvm" in prefs:
-            default_dispvm = self.app.domains[prefs["default_dispvm"]]
-            if vm.default_dispvm != default_dispvm:
-                vm.default_dispvm = default_dispvm
-                changed = True
-                values_changed.append("default_dispvm")
-        if "template" in prefs:
-            template = self.app.domains[prefs["template"]]
-            if vm.template != template:
-                vm.template = template
+        vm, _ = self.ensure_present(vmname, vmtype, label, vmtemplate)
+        # Qube-valued properties are resolved from the requested names
+        resolvers = {
+            "netvm": self.__resolve_netvm,
+            "default_dispvm": self.__resolve_vm,
+            "template": self.__resolve_vm,
+        }
+        keys = [key for key in VM_PROPS if key in prefs]
+
+        # Compare each key only once the earlier ones are written, as some
+        # values follow others (vcpus and virt_mode follow the template)
+        for key in keys:
+            value = prefs[key]
+            if key in resolvers:
+                value = resolvers[key](value)
+            current = vm.label.name if key == "label" else getattr(vm, key)
+            if current != value:
+                setattr(vm, key, value)
                 changed = True
-                values_changed.append("template")
-        if (
-            "template_for_dispvms" in prefs
-            and vm.template_for_dispvms != prefs["template_for_dispvms"]
-        ):
-            vm.template_for_dispvms = prefs["template_for_dispvms"]
-            changed = True
-            values_changed.append("template_for_dispvms")
-        if "vcpus" in prefs and vm.vcpus != prefs["vcpus"]:
-            vm.vcpus = prefs["vcpus"]
-            changed = True
-            values_changed.append("vcpus")
-        if "virt_mode" in prefs and vm.virt_mode != prefs["virt_mode"]:
-            vm.virt_mode = prefs["virt_mode"]
-            changed = True
-            values_changed.append("virt_mode")
+                values_changed.append(key)
         if "services" in prefs:
             did_feature_changed = False
             for service in prefs["services"]:
@@ -516,25 +555,25 @@ class QubesVirt(object):
             if did_feature_changed:
                 values_changed.append("features")
         if "features" in prefs:
-            did_feature_changed = False
-            for key, value in prefs["features"].items():
-                if value == "" and key in vm.features:
-                    vm.features[key] = ""
-                    changed = True
-                    did_feature_changed = True
-                elif value == "None" and key in vm.features:
-                    del vm.features[key]
-                    changed = True
-                    did_feature_changed = True
-                elif key in vm.features and value != vm.features[key]:
-                    vm.features[key] = value
-                    changed = True
-                    did_feature_changed = True
-                elif not key in vm.features and value != "None":
-                    vm.features[key] = value
-                    changed = True
-                    did_feature_changed = True
-            if did_feature_changed:
+            # Work out the delta first so that only real changes are written
+            present = set(vm.features)
+            to_del = [
+                key
+                for key, value in prefs["features"].items()
+                if value == "None" and key in present
+            ]
+            to_set = {
+                key: value
+                for key, value in prefs["features"].items()
+                if value != "None"
+                and (key not in present or vm.features[key] != value)
+            }
+            for key in to_del:
+                del vm.features[key]
+            for key, value in to_set.items():
+                vm.features[key] = value
+            if to_del or to_set:
+                changed = True
                 values_changed.append("features")
         if "volume" in prefs:
             val = prefs["volume"]
@@ -555,10 +594,18 @@ class QubesVirt(object):
             self.destroy(vmname)
         except QubesVMNotStartedError:
             pass
-        while True:
-            if self.__get_state(vmname) == "shutdown":
-                break
-            time.sleep(1)
+        vm = self.get_vm(vmname)
+        # Poll with an exponential backoff, as a killed qube usually halts
+        # well within the first second
+        delay = 0.05
+        deadline = time.monotonic() + vm.shutdown_timeout
+        while not vm.is_halted():
+            if time.monotonic() >= deadline:
+                raise RuntimeError(
+                    f"Timeout: VM {vmname} did not halt within {vm.shutdown_timeout}s"
+                )
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
         del self.app.domains[vmname]
         return 0
 
@@ -566,33 +613,36 @@ class QubesVirt(object):
         """
         Return a state suitable for server consumption.  Aka, codes.py values, not XM output.
         """
-        return self.__get_state(vmname)
+        return self.__get_state(self.get_vm(vmname))
 
     def tags(self, vmname, tags):
         """Add a list of tags to a qube, skipping any already present."""
         vm = self.get_vm(vmname)
-        updated_tags = []
-        for tag in tags:
-            if tag in vm.tags:
-                continue
+        current = set(vm.tags)
+        # dict.fromkeys drops duplicates while keeping the requested order
+        updated_tags = [
+            tag for tag in dict.fromkeys(tags) if tag not in current
+        ]
+        for tag in updated_tags:
             vm.tags.add(tag)
-            updated_tags.append(tag)
         return updated_tags
 
     def parse_device(self, spec):
-        """Parse a device specification string into its class and VirtualDevice."""
+        """Parse a device specification string into its class and VirtualDevice.
+
+        Raises ValueError for an invalid specification.
+        """
         parts = spec.split(":", 1)
         if len(parts) != 2:
-            self.module.fail_json(msg=f"Invalid spec {spec}")
+            raise ValueError(f"Invalid spec {spec}")
         devclass, rest = parts
-        if devclass not in self.get_device_classes():
-            self.module.fail_json(msg=f"Invalid devclass {devclass}")
+        if devclass not in self.device_classes:
+            raise ValueError(f"Invalid devclass {devclass}")
         try:
             device = VirtualDevice.from_str(rest, devclass, self.app.domains)
-            return devclass, device
         except Exception as e:
-            self.module.fail_json(msg=f"Cannot parse device {spec}: {e}")
-            return None
+            raise ValueError(f"Cannot parse device {spec}: {e}") from e
+        return devclass, device
 
     def list_assigned_devices(self, vmname, devclass):
         """List currently assigned devices of a given class for a qube."""
@@ -607,6 +657,15 @@ class QubesVirt(object):
             current[spec] = (mode, opts)
         return current
 
+    def assigned_devices(self, vmname):
+        """Map each device class with assignments on a qube to its devices."""
+        assigned = {}
+        for devclass in self.device_classes:
+            current = self.list_assigned_devices(vmname, devclass)
+            if current:
+                assigned[devclass] = current
+        return assigned
+
     def assign(self, vmname, devclass, device_assignment):
         """Assign a device to the specified qube."""
         vm = self.get_vm(vmname)
@@ -619,8 +678,12 @@ class QubesVirt(object):
         vm.devices[devclass].unassign(device_assignment)
         return 0
 
-    def sync_devices(self, vmname, devclass, desired):
-        """Synchronize a qube's device assignments to match the desired configuration."""
+    def sync_devices(self, vmname, devclass, desired, current_map=None):
+        """Synchronize a qube's device assignments to match the desired configuration.
+
+        current_map, as returned by list_assigned_devices(), is looked up when
+        not given.
+        """
         # build desired map: spec -> (vd, per_mode, opts)
         desired_map = {
             f"{devclass}:{vd.backend_domain}:{vd.port_id}": (
@@ -632,9 +695,11 @@ class QubesVirt(object):
         }
 
         changed = False
+        vm = self.get_vm(vmname)
 
         # current assignments: spec -> (mode, opts)
-        current_map = self.list_assigned_devices(vmname, devclass)
+        if current_map is None:
+            current_map = self.list_assigned_devices(vmname, devclass)
         current_specs = set(current_map)
         desired_specs = set(desired_map)
 
@@ -644,7 +709,7 @@ class QubesVirt(object):
             self.unassign(
                 vmname,
                 cls,
-                DeviceAssignment(dev, frontend_domain=self.get_vm(vmname)),
+                DeviceAssignment(dev, frontend_domain=vm),
             )
             changed = True
 
@@ -657,12 +722,12 @@ class QubesVirt(object):
                 "required" if devclass == "pci" else "auto-attach"
             )
             if existing_mode.value != desired_mode or existing_opts != opts:
-                # tear down the old and set up the new
-                cls, dev = self.parse_device(spec)
+                # tear down the old and set up the new; the spec names the
+                # same device as vd, so there is nothing to re-parse
                 self.unassign(
                     vmname,
-                    cls,
-                    DeviceAssignment(dev, frontend_domain=self.get_vm(vmname)),
+                    devclass,
+                    DeviceAssignment(vd, frontend_domain=vm),
                 )
                 self.assign(
                     vmname,
@@ -687,9 +752,66 @@ class QubesVirt(object):
         return changed
 
 
+# Single-command operations dispatched at the end of core(), by command name
+VM_DISPATCH = {
+    "destroy": QubesVirt.destroy,
+    "pause": QubesVirt.pause,
+    "remove": QubesVirt.remove,
+    "shutdown": QubesVirt.shutdown,
+    "start": QubesVirt.start,
+    "status": QubesVirt.status,
+    "stop": QubesVirt.shutdown,
+    "unpause": QubesVirt.unpause,
+}
+HOST_DISPATCH = {
+    "info": QubesVirt.info,
+}
+
+
 def core(module):
-    state = module.params.get("state", None)
     guest = module.params.get("name", None)
+    v = QubesVirt(module)
+
+    # The name is a raw parameter, so that it can also be a list of names;
+    # numbers are turned into strings, as Ansible does for str parameters
+    if isinstance(guest, (int, float)):
+        guest = str(guest)
+    if isinstance(guest, list):
+        guest = [
+            str(name) if isinstance(name, (int, float)) else name
+            for name in guest
+        ]
+        if not guest or not all(isinstance(name, str) for name in guest):
+            return VIRT_FAILED, {"Invalid name": guest}
+    elif guest is not None and not isinstance(guest, str):
+        return VIRT_FAILED, {"Invalid name": guest}
+
+    if not isinstance(guest, list):
+        return core_guest(module, v, guest)
+
+    # A list of names applies the same task to each qube in turn, sharing
+    # one admin API connection
+    results = {}
+    for name in guest:
+        rc, res = core_guest(module, v, name)
+        if rc != VIRT_SUCCESS:
+            # Report the qubes already handled along with the failure
+            return rc, {
+                "msg": {name: res},
+                "changed": any_changed(results),
+                "results": results,
+            }
+        results[name] = res
+    return VIRT_SUCCESS, {"changed": any_changed(results), "results": results}
+
+
+def any_changed(results):
+    """Whether the task changed any of the qubes in a per-name result map."""
+    return any(res.get("changed", False) for res in results.values())
+
+
+def core_guest(module, v, guest):
+    state = module.params.get("state", None)
     command = module.params.get("command", None)
     vmtype = module.params.get("vmtype", "AppVM")
     label = module.params.get("label", "red")
@@ -701,8 +823,6 @@ def core(module):
     res = {}
     device_specs = []
 
-    v = QubesVirt(module)
-
     # Normalize devices into (set_mode, device_specs)
     if isinstance(devices, dict):
         set_mode = devices.get("strategy", "strict")
@@ -712,43 +832,54 @@ def core(module):
         set_mode = "strict"
         device_specs = devices
     else:
-        module.fail_json(msg=f"Invalid devices parameter: {devices!r}")
+        return VIRT_FAILED, {"Error": f"Invalid devices parameter: {devices!r}"}
+    if set_mode not in ("strict", "append"):
+        return VIRT_FAILED, {"Error": f"Invalid devices strategy: {set_mode}"}
 
-    # Now expand each spec into (class, VirtualDevice, per_mode, options)
-    normalized_devices = []
+    # Now expand each spec into (VirtualDevice, per_mode, options),
+    # bucketed by device class
+    devices_by_class = {}
     for entry in device_specs:
         if isinstance(entry, str):
             # simple string spec -> no per-device mode or options
-            cls, vd = v.parse_device(entry)
-            normalized_devices.append((cls, vd, None, []))
+            device_str, per_mode, opts = entry, None, []
         elif isinstance(entry, dict):
             # dict spec must have a "device" key
             device_str = entry.get("device")
             if not device_str:
-                module.fail_json(
-                    msg=f"Device entry missing 'device': {entry!r}"
-                )
-            cls, vd = v.parse_device(device_str)
+                return VIRT_FAILED, {
+                    "Error": f"Device entry missing 'device': {entry!r}"
+                }
             # optional per-device mode (e.g. "required" or "auto-attach")
             per_mode = entry.get("mode")
             # optional options list
             opts = entry.get("options", {})
-            normalized_devices.append((cls, vd, per_mode, opts))
         else:
-            module.fail_json(msg=f"Invalid device entry: {entry!r}")
+            return VIRT_FAILED, {"Error": f"Invalid device entry: {entry!r}"}
+        try:
+            cls, vd = v.parse_device(device_str)
+        except ValueError as e:
+            return VIRT_FAILED, {"Error": str(e)}
+        devices_by_class.setdefault(cls, []).append((vd, per_mode, opts))
 
     def apply_devices(vmname):
         devices_changed = False
-        for device_class in v.get_device_classes():
-            # gather only the entries for this class
-            wants = [
-                (vd, per_mode, opts)
-                for (cls, vd, per_mode, opts) in normalized_devices
-                if cls == device_class
-            ]
-            if set_mode == "strict":
-                devices_changed |= v.sync_devices(vmname, device_class, wants)
-            elif set_mode == "append":
+        if set_mode == "strict":
+            # only classes with listed or assigned devices can change
+            assigned = v.assigned_devices(vmname)
+            for device_class in devices_by_class.keys() | assigned.keys():
+                devices_changed |= v.sync_devices(
+                    vmname,
+                    device_class,
+                    devices_by_class.get(device_class, []),
+                    assigned.get(device_class, {}),
+                )
+        else:
+            if not devices_by_class:
+                # nothing to add, and append never removes anything
+                return False
+            # only the classes of the listed devices can change
+            for device_class, wants in devices_by_class.items():
                 current_map = v.list_assigned_devices(vmname, device_class)
                 for vd, per_mode, opts in wants:
                     spec = f"{device_class}:{vd.backend_domain}:{vd.port_id}"
@@ -765,35 +896,57 @@ def core(module):
                         DeviceAssignment(vd, mode=assign_mode, options=opts),
                     )
                     devices_changed = True
-            else:
-                module.fail_json(msg=f"Invalid devices strategy: {set_mode}")
         return devices_changed
 
     # gather device facts
     if module.params.get("gather_device_facts", False):
+        found = v.find_devices_of_classes("02", "0c03", "0403")
         facts = {
-            "pci_net": sorted(
-                [f"pci:dom0:{dev}" for dev in v.find_devices_of_class("02")]
-            ),
-            "pci_usb": sorted(
-                [f"pci:dom0:{dev}" for dev in v.find_devices_of_class("0c03")]
-            ),
-            "pci_audio": sorted(
-                [f"pci:dom0:{dev}" for dev in v.find_devices_of_class("0403")]
-            ),
+            fact: sorted(f"pci:dom0:{dev}" for dev in found[klass])
+            for fact, klass in (
+                ("pci_net", "02"),
+                ("pci_usb", "0c03"),
+                ("pci_audio", "0403"),
+            )
         }
         return VIRT_SUCCESS, {"changed": False, "ansible_facts": facts}
 
     # properties will only work with state=present
     if properties:
+        unknown = properties.keys() - PROPS.keys()
+        if unknown:
+            # Sorted, so that the same property is reported on every run
+            return VIRT_FAILED, {"Invalid property": sorted(unknown)[0]}
+        # Check everything that needs no admin API call first
         for key, val in properties.items():
-            if key not in PROPS:
-                return VIRT_FAILED, {"Invalid property": key}
-            if type(val) != PROPS[key]:
+            # bool is a subclass of int, so reject it explicitly for ints
+            if not isinstance(val, PROPS[key]) or (
+                PROPS[key] is int and isinstance(val, bool)
+            ):
                 return VIRT_FAILED, {"Invalid property value type": key}
 
-            # Make sure that the netvm exists
-            if key == "netvm" and val not in ["*default*", "", "none", "None"]:
+        # Make sure volume has both name and value
+        if "volume" in properties:
+            val = properties["volume"]
+            if "name" not in val:
+                return VIRT_FAILED, {"Missing name for the volume": val}
+            if "size" not in val:
+                return VIRT_FAILED, {"Missing size for the volume": val}
+
+            allowed_name = []
+            if vmtype == "AppVM":
+                allowed_name.append("private")
+            elif vmtype in ["StandAloneVM", "TemplateVM"]:
+                allowed_name.append("root")
+
+            if not val["name"] in allowed_name:
+                return VIRT_FAILED, {"Wrong volume name": val}
+
+        # Make sure that the netvm exists
+        val = properties.get("netvm")
+        if val is not None and val not in ["*default*", "", "none", "None"]:
+            netvm = v.validated_vms.get(("netvm", val))
+            if netvm is None:
                 try:
                     vm = v.get_vm(val)
                 except KeyError:
@@ -801,33 +954,19 @@ def core(module):
                 # Also the vm should provide network
                 if not vm.provides_network:
                     return VIRT_FAILED, {"Missing netvm capability": val}
-                netvm = vm
-
-            # Make sure volume has both name and value
-            if key == "volume":
-                if "name" not in val:
-                    return VIRT_FAILED, {"Missing name for the volume": val}
-                if "size" not in val:
-                    return VIRT_FAILED, {"Missing size for the volume": val}
-
-                allowed_name = []
-                if vmtype == "AppVM":
-                    allowed_name.append("private")
-                elif vmtype in ["StandAloneVM", "TemplateVM"]:
-                    allowed_name.append("root")
-
-                if not val["name"] in allowed_name:
-                    return VIRT_FAILED, {"Wrong volume name": val}
-
-            # Make sure that the default_dispvm exists
-            if key == "default_dispvm":
-                try:
-                    vm = v.get_vm(val)
-                except KeyError:
-                    return VIRT_FAILED, {"Missing default_dispvm": val}
-                # Also the vm should provide network
-                if not vm.template_for_dispvms:
-                    return VIRT_FAILED, {"Missing dispvm capability": val}
+                netvm = v.validated_vms[("netvm", val)] = vm
+
+        # Make sure that the default_dispvm exists
+        val = properties.get("default_dispvm")
+        if val is not None and ("default_dispvm", val) not in v.validated_vms:
+            try:
+                vm = v.get_vm(val)
+            except KeyError:
+                return VIRT_FAILED, {"Missing default_dispvm": val}
+            # Also the vm should provide network
+            if not vm.template_for_dispvms:
+                return VIRT_FAILED, {"Missing dispvm capability": val}
+            v.validated_vms[("default_dispvm", val)] = vm
 
         if state == "present" and guest and vmtype:
             prop_changed, prop_vals = v.properties(
@@ -849,12 +988,11 @@ def core(module):
 
     # This is without any properties
     if state == "present" and guest:
-        try:
-            v.get_vm(guest)
+        _, created = v.ensure_present(guest, vmtype, label, template)
+        if not created:
             dev_changed = apply_devices(guest)
             res = {"changed": dev_changed}
-        except KeyError:
-            v.create(guest, vmtype, label, template)
+        else:
             # Apply the tags
             tags_changed = []
             if tags:
@@ -886,12 +1024,14 @@ def core(module):
     if command:
         if command in VM_COMMANDS:
             if not guest:
-                module.fail_json(msg=f"{command} requires 1 argument: guest")
+                return VIRT_FAILED, {
+                    "Error": f"{command} requires 1 argument: guest"
+                }
             if command == "create":
-                try:
-                    v.get_vm(guest)
-                except KeyError:
-                    v.create(guest, vmtype, label, template, netvm)
+                _, created = v.ensure_present(
+                    guest, vmtype, label, template, netvm
+                )
+                if created:
                     res = {"changed": True, "created": guest}
                 return VIRT_SUCCESS, res
             elif command == "removetags":
@@ -899,7 +1039,8 @@ def core(module):
                 changed = False
                 if not tags:
                     return VIRT_FAILED, {"Error": "Missing tag(s) to remove."}
-                for tag in tags:
+                current = set(vm.tags)
+                for tag in current.intersection(tags):
                     try:
                         vm.tags.remove(tag)
                         changed = True
@@ -909,22 +1050,24 @@ def core(module):
                     "Message": "Removed the tag(s).",
                     "changed": changed,
                 }
-            res = getattr(v, command)(guest)
+            res = VM_DISPATCH[command](v, guest)
             if not isinstance(res, dict):
                 res = {command: res}
             return VIRT_SUCCESS, res
-        elif hasattr(v, command):
-            res = getattr(v, command)()
+        elif command in HOST_DISPATCH:
+            res = HOST_DISPATCH[command](v)
             if not isinstance(res, dict):
                 res = {command: res}
             return VIRT_SUCCESS, res
 
         else:
-            module.fail_json(msg=f"Command {command} not recognized")
+            return VIRT_FAILED, {"Error": f"Command {command} not recognized"}
 
     if state:
         if not guest:
-            module.fail_json(msg="State change requires a guest specified")
+            return VIRT_FAILED, {
+                "Error": "State change requires a guest specified"
+            }
         current = v.status(guest)
         if state == "running":
             if current == "paused":
@@ -939,14 +1082,14 @@ def core(module):
                 try:
                     v.shutdown(guest, wait=module.params.get("wait", False))
                 except RuntimeError as e:
-                    module.fail_json(msg=str(e))
+                    return VIRT_FAILED, {"Error": str(e)}
         elif state == "restarted":
             res["changed"] = True
             try:
                 v.restart(guest, wait=module.params.get("wait", False))
                 res["msg"] = "restarted"
             except RuntimeError as e:
-                module.fail_json(msg=str(e))
+                return VIRT_FAILED, {"Error": str(e)}
         elif state == "destroyed":
             if current != "shutdown":
                 res["changed"] = True
@@ -960,19 +1103,19 @@ def core(module):
                 res["changed"] = True
                 res["msg"] = v.remove(guest)
         else:
-            module.fail_json(msg="Unexpected state")
+            return VIRT_FAILED, {"Error": "Unexpected state"}
 
         return VIRT_SUCCESS, res
 
-    module.fail_json(msg="Expected state or command parameter to be specified")
-
-    return None
+    return VIRT_FAILED, {
+        "Error": "Expected state or command parameter to be specified"
+    }
 
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            name=dict(type="str", aliases=["guest"]),
+            name=dict(type="raw", aliases=["guest"]),
             state=dict(
                 type="str",
                 choices=[
@@ -1010,6 +1153,9 @@ def main():
         module.fail_json(msg=to_native(e), exception=traceback.format_exc())
 
     if rc != 0:  # something went wrong emit the msg
+        if "results" in result:
+            # A list of names failed part way, after changing some qubes
+            module.fail_json(rc=rc, **result)
         module.fail_json(rc=rc, msg=result)
     else:
         module.exit_json(**result)
@@ -1,3 +1,5 @@
+import concurrent.futures
+import time
 import uuid
 
 import pytest
@@ -6,8 +8,19 @@ import qubesadmin
 from plugins.modules.qubesos import core
 
 
+def pytest_configure(config):
+    # Registered here so that runs without pytest-xdist do not warn about it
+    config.addinivalue_line(
+        "markers",
+        "xdist_group(name): run under pytest-xdist --dist=loadgroup in a "
+        "single worker, for tests that look at every qube on the host",
+    )
+
+
 # Helper to run the module core function
 class Module:
+    __slots__ = ("params",)
+
     def __init__(self, params):
         self.params = params
 
@@ -18,6 +31,16 @@ class Module:
         return
 
 
+def wait_until(predicate, timeout=30, interval=0.1):
+    """Poll predicate until it is true or timeout seconds have passed"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
 @pytest.fixture(scope="function")
 def qubes():
     """Return a Qubes app instance"""
@@ -33,26 +56,38 @@ def vmname():
     return f"test-vm-{uuid.uuid4().hex[:8]}"
 
 
-@pytest.fixture(scope="function")
-def vm(qubes, request):
-    """Generate a VM with default configurations"""
-    vmname = f"test-vm-{uuid.uuid4().hex[:8]}"
-    core(Module({"state": "present", "name": vmname}))
-    request.node.mark_vm_created(vmname)
+def session_qube(vmname, properties):
+    """Create a qube for the whole session, removing it afterwards"""
+    try:
+        app = qubesadmin.Qubes()
+    except Exception as e:
+        pytest.skip(f"Qubes API not available: {e}")
+    params = {"state": "present", "name": vmname}
+    if properties:
+        params["properties"] = properties
+    core(Module(params))
+    try:
+        app.domains.refresh_cache(force=True)
+        yield app.domains[vmname]
+    finally:
+        try:
+            core(Module({"command": "remove", "name": vmname}))
+        except Exception:
+            pass
 
-    qubes.domains.refresh_cache(force=True)
-    return qubes.domains[vmname]
 
+@pytest.fixture(scope="session")
+def vm():
+    """Generate a VM with default configurations, shared by the session"""
+    yield from session_qube(f"test-vm-{uuid.uuid4().hex[:8]}", None)
 
-@pytest.fixture(scope="function")
-def minimalvm(qubes, request):
-    vmname = f"test-minimalvm-{uuid.uuid4().hex[:8]}"
-    props = {"template": "debian-12-minimal"}
-    core(Module({"state": "present", "name": vmname, "properties": props}))
-    request.node.mark_vm_created(vmname)
 
-    qubes.domains.refresh_cache(force=True)
-    return qubes.domains[vmname]
+@pytest.fixture(scope="session")
+def minimalvm():
+    yield from session_qube(
+        f"test-minimalvm-{uuid.uuid4().hex[:8]}",
+        {"template": "debian-12-minimal"},
+    )
 
 
 @pytest.fixture(scope="function")
@@ -76,24 +111,37 @@ def cleanup_vm(qubes, request):
 
     request.node.mark_vm_created = mark
     yield
-    # Teardown (remove VMs)
-    for name in created:
+
+    # Teardown (remove VMs), in parallel as each removal waits for a halt
+    def remove(name):
         try:
             core(Module({"command": "remove", "name": name}))
         except Exception:
             pass
 
+    if created:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(8, len(created))
+        ) as executor:
+            list(executor.map(remove, created))
 
-@pytest.fixture
-def latest_net_ports(qubes):
-    # Collect all net‐class PCI port_ids from dom0
+
+@pytest.fixture(scope="session")
+def latest_net_ports():
+    # Collect all net‐class PCI port_ids from dom0, once per session as the
+    # PCI devices do not change during a run
     # See fepitre/qubes-g2g-continuous-integration
+    try:
+        app = qubesadmin.Qubes()
+    except Exception as e:
+        pytest.skip(f"Qubes API not available: {e}")
     ports = [
         f"pci:dom0:{dev.port_id}"
-        for dev in qubes.domains["dom0"].devices["pci"]
+        for dev in app.domains["dom0"].devices["pci"]
         if repr(dev.interfaces[0]).startswith("p02")
     ]
-    assert len(ports) >= 2, "Need at least two PCI net devices for these tests"
+    if len(ports) < 2:
+        pytest.skip("Need at least two PCI net devices for these tests")
     return ports
 
 
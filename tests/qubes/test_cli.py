@@ -13,6 +13,47 @@ ANSIBLE_CONFIG = os.environ.get(
 )
 
 
+def task_result(output, task_name, host):
+    """
+    Find a host's result for the named task in json callback output.
+    """
+    for play in output["plays"]:
+        for task in play["tasks"]:
+            if task["task"]["name"] == task_name:
+                return task["hosts"][host]
+    raise KeyError(task_name)
+
+
+# Play attributes and the user each of them should run commands as
+CONNECTION_USERS = [
+    ({}, "user"),
+    ({"remote_user": "user"}, "user"),
+    ({"remote_user": "root"}, "root"),
+    ({"become": True}, "root"),
+]
+
+
+def whoami_plays(play_attrs, users):
+    """
+    Build one play per entry of users, each checking the output of whoami.
+    """
+    return [
+        {
+            **play_attrs,
+            **attrs,
+            "tasks": [
+                {
+                    "name": f"VM user with {attrs or 'defaults'} is '{user}'",
+                    "ansible.builtin.command": "whoami",
+                    "register": "whoami_result",
+                    "failed_when": f"whoami_result.stdout != '{user}'",
+                },
+            ],
+        }
+        for attrs, user in users
+    ]
+
+
 @pytest.fixture
 def run_playbook(tmp_path):
     """
@@ -21,10 +62,9 @@ def run_playbook(tmp_path):
 
     def _run(playbook_content: List[dict], vms: List[str] = []):
         # Create playbook file
+        # JSON is valid YAML, and json is quicker to emit than PyYAML
         pb_file = tmp_path / "playbook.yml"
-        import yaml
-
-        pb_file.write_text(yaml.dump(playbook_content))
+        pb_file.write_text(json.dumps(playbook_content))
         # Run ansible-playbook
         cmd = [
             "ansible-playbook",
@@ -119,17 +159,16 @@ def test_properties_and_tags_playbook(run_playbook, request):
     assert result.returncode == 0, result.stderr
 
     # Ensure properties and tags were applied
-    run_output = json.loads(result.stdout)
-    assert run_output["plays"][0]["tasks"][1]["hosts"]["localhost"][
-        "changed"
-    ], result.stdout
+    create_result = task_result(
+        json.loads(result.stdout), "Create VM with properties", "localhost"
+    )
+    assert create_result["changed"], result.stdout
     assert {"tag1", "tag2"} == set(
-        run_output["plays"][0]["tasks"][1]["hosts"]["localhost"].get(
-            "Tags updated", []
-        )
+        create_result.get("Tags updated", [])
     ), result.stdout
 
 
+@pytest.mark.xdist_group("global_state")
 def test_inventory_playbook(run_playbook, tmp_path, qubes):
     # Generate inventory via playbook
     playbook = [
@@ -153,11 +192,17 @@ def test_inventory_playbook(run_playbook, tmp_path, qubes):
 
     # Should contain at least one VM entry under [appvms]
     assert "[appvms]" in content
+    appvms_section = content.split("[appvms]", 1)[1].split("[", 1)[0]
+    appvms = {line.strip() for line in appvms_section.splitlines()}
+    appvms.discard("")
 
     # Compare with qubes.domains data
-    for vm in qubes.domains.values():
-        if vm.name != "dom0" and vm.klass == "AppVM":
-            assert vm.name in content
+    expected = {
+        vm.name
+        for vm in qubes.domains.values()
+        if vm.name != "dom0" and vm.klass == "AppVM"
+    }
+    assert expected <= appvms, expected - appvms
 
 
 def test_vm_connection(vm, run_playbook):
@@ -165,78 +210,16 @@ def test_vm_connection(vm, run_playbook):
         "hosts": vm.name,
         "gather_facts": False,
         "connection": "qubes",
+        # Cover put_file and the separate module execution, which pipelining
+        # (enabled in the test config) bypasses
+        "vars": {"ansible_pipelining": False},
     }
 
-    default_user_playbook = [
-        {
-            **play_attrs,
-            "tasks": [
-                {
-                    "name": "Default VM user is 'user'",
-                    "ansible.builtin.command": "whoami",
-                    "register": "default_result",
-                    "failed_when": "default_result.stdout != 'user'",
-                },
-            ],
-        },
-    ]
-
-    default_user_result = run_playbook(default_user_playbook, vms=[vm.name])
-    assert default_user_result.returncode == 0, default_user_result.stdout
-
-    connect_user_playbook = [
-        {
-            **play_attrs,
-            "remote_user": "user",
-            "tasks": [
-                {
-                    "name": "VM user with 'remote_user: user' is 'user'",
-                    "ansible.builtin.command": "whoami",
-                    "register": "user_result",
-                    "failed_when": "user_result.stdout != 'user'",
-                },
-            ],
-        },
-    ]
-
-    connect_user_result = run_playbook(connect_user_playbook, vms=[vm.name])
-    assert connect_user_result.returncode == 0, connect_user_result.stdout
+    # One ansible-playbook run covers every user that should succeed
+    playbook = whoami_plays(play_attrs, CONNECTION_USERS)
 
-    connect_root_playbook = [
-        {
-            **play_attrs,
-            "remote_user": "root",
-            "tasks": [
-                {
-                    "name": "VM user with 'remote_user: root' is 'root'",
-                    "ansible.builtin.command": "whoami",
-                    "register": "root_result",
-                    "failed_when": "root_result.stdout != 'root'",
-                },
-            ],
-        },
-    ]
-
-    connect_root_result = run_playbook(connect_root_playbook, vms=[vm.name])
-    assert connect_root_result.returncode == 0, connect_root_result.stdout
-
-    become_playbook = [
-        {
-            **play_attrs,
-            "become": True,
-            "tasks": [
-                {
-                    "name": "VM user with 'become: true' is 'root'",
-                    "ansible.builtin.command": "whoami",
-                    "register": "become_result",
-                    "failed_when": "become_result.stdout != 'root'",
-                },
-            ],
-        },
-    ]
-
-    become_result = run_playbook(become_playbook, vms=[vm.name])
-    assert become_result.returncode == 0, become_result.returncode
+    result = run_playbook(playbook, vms=[vm.name])
+    assert result.returncode == 0, result.stdout
 
     invalid_user = "somebody"
     invalid_user_playbook = [
@@ -269,89 +252,169 @@ def test_minimalvm_connection(minimalvm, run_playbook):
         "connection": "qubes",
     }
 
-    default_user_playbook = [
+    # One ansible-playbook run covers every user that should succeed;
+    # become is checked separately, as it fails on the minimal template
+    playbook = whoami_plays(play_attrs, CONNECTION_USERS[:3])
+
+    result = run_playbook(playbook, vms=[minimalvm.name])
+    assert result.returncode == 0, result.stdout
+
+    become_playbook = [
         {
             **play_attrs,
+            "become": True,
             "tasks": [
                 {
-                    "name": "Default minimal VM user is 'user'",
-                    "ansible.builtin.command": "whoami",
-                    "register": "default_result",
-                    "failed_when": "default_result.stdout != 'user'",
+                    "name": "No-op",
+                    "ansible.builtin.command": "true",
                 },
             ],
         },
     ]
 
-    default_user_result = run_playbook(
-        default_user_playbook, vms=[minimalvm.name]
-    )
-    assert default_user_result.returncode == 0, default_user_result.stdout
+    become_result = run_playbook(become_playbook, vms=[minimalvm.name])
+    # Playbook should fail because "become" isn't possibile on unmodified minimal vms.
+    assert become_result.returncode == 2, become_result.stdout
 
-    connect_user_playbook = [
+    become_output = json.loads(become_result.stdout)
+    become_module_result = become_output["plays"][0]["tasks"][0]["hosts"][
+        minimalvm.name
+    ]
+    assert become_module_result["failed"], become_result.stdout
+    assert become_module_result["rc"] == 1, become_result.stdout
+    assert (
+        become_module_result["module_stderr"].rstrip()
+        == "sudo: a password is required"
+    ), become_result.stdout
+
+
+def test_vm_persistent_session(vm, run_playbook):
+    playbook = [
         {
-            **play_attrs,
-            "remote_user": "user",
+            "hosts": vm.name,
+            "gather_facts": False,
+            "connection": "qubes",
+            "vars": {
+                "ansible_qubes_persistent_session": True,
+                # Only commands without data on stdin use the session
+                "ansible_pipelining": False,
+            },
             "tasks": [
                 {
-                    "name": "Minimal VM user with 'remote_user: user' is 'user'",
+                    "name": "Commands share a single shell session",
                     "ansible.builtin.command": "whoami",
-                    "register": "user_result",
-                    "failed_when": "user_result.stdout != 'user'",
+                    "register": "first_result",
+                    "failed_when": "first_result.stdout != 'user'",
+                },
+                {
+                    "name": "Exit status is reported through the session",
+                    "ansible.builtin.command": "false",
+                    "register": "false_result",
+                    "failed_when": "false_result.rc != 1",
+                },
+                {
+                    "name": "Session is still usable after a failure",
+                    "ansible.builtin.shell": "echo out; echo err >&2",
+                    "register": "shell_result",
+                    "failed_when": "shell_result.stdout != 'out' or shell_result.stderr != 'err'",
                 },
             ],
         },
     ]
 
-    connect_user_result = run_playbook(
-        connect_user_playbook, vms=[minimalvm.name]
-    )
-    assert connect_user_result.returncode == 0, connect_user_result.stdout
+    result = run_playbook(playbook, vms=[vm.name])
+    assert result.returncode == 0, result.stdout
 
-    connect_root_playbook = [
+
+def test_vm_batch_put(vm, run_playbook):
+    playbook = [
         {
-            **play_attrs,
-            "remote_user": "root",
+            "hosts": vm.name,
+            "gather_facts": False,
+            "connection": "qubes",
+            "vars": {"ansible_qubes_batch_put": True},
             "tasks": [
                 {
-                    "name": "Minimal VM user with 'remote_user: root' is 'root'",
-                    "ansible.builtin.command": "whoami",
-                    "register": "root_result",
-                    "failed_when": "root_result.stdout != 'root'",
+                    "name": "Modules are transferred along with the next command",
+                    "ansible.builtin.copy": {
+                        "content": "batched\n",
+                        "dest": "/home/user/batched.txt",
+                    },
+                },
+                {
+                    "name": "Copied file has the expected content",
+                    "ansible.builtin.command": "cat /home/user/batched.txt",
+                    "register": "cat_result",
+                    "failed_when": "cat_result.stdout != 'batched'",
                 },
             ],
         },
     ]
 
-    connect_root_result = run_playbook(
-        connect_root_playbook, vms=[minimalvm.name]
-    )
-    assert connect_root_result.returncode == 0, connect_root_result.stdout
+    result = run_playbook(playbook, vms=[vm.name])
+    assert result.returncode == 0, result.stdout
 
-    become_playbook = [
+
+def test_vm_batch_put_with_persistent_session(vm, run_playbook):
+    # Above the 128 KiB limit on the size of a single command argument
+    size = 200 * 1024
+    playbook = [
         {
-            **play_attrs,
-            "become": True,
+            "hosts": vm.name,
+            "gather_facts": False,
+            "connection": "qubes",
+            "vars": {
+                "ansible_qubes_batch_put": True,
+                "ansible_qubes_persistent_session": True,
+                # Send the modules with put_file rather than on stdin
+                "ansible_pipelining": False,
+            },
             "tasks": [
                 {
-                    "name": "No-op",
-                    "ansible.builtin.command": "true",
+                    "name": "Large batched files are transferred",
+                    "ansible.builtin.copy": {
+                        "content": f"{{{{ 'x' * {size} }}}}",
+                        "dest": "/home/user/batched-large.txt",
+                    },
+                },
+                {
+                    "name": "Copied file has the expected size",
+                    "ansible.builtin.command": "stat -c %s /home/user/batched-large.txt",
+                    "register": "stat_result",
+                    "failed_when": f"stat_result.stdout != '{size}'",
                 },
             ],
         },
     ]
 
-    become_result = run_playbook(become_playbook, vms=[minimalvm.name])
-    # Playbook should fail because "become" isn't possibile on unmodified minimal vms.
-    assert become_result.returncode == 2, become_result.stdout
+    result = run_playbook(playbook, vms=[vm.name])
+    assert result.returncode == 0, result.stdout
 
-    become_output = json.loads(become_result.stdout)
-    become_module_result = become_output["plays"][0]["tasks"][0]["hosts"][
-        minimalvm.name
+
+def test_vm_compress_put(vm, run_playbook):
+    playbook = [
+        {
+            "hosts": vm.name,
+            "gather_facts": False,
+            "connection": "qubes",
+            "vars": {"ansible_qubes_compress_put": True},
+            "tasks": [
+                {
+                    "name": "Files are compressed during the transfer",
+                    "ansible.builtin.copy": {
+                        "content": "compressed\n",
+                        "dest": "/home/user/compressed.txt",
+                    },
+                },
+                {
+                    "name": "Copied file has the expected content",
+                    "ansible.builtin.command": "cat /home/user/compressed.txt",
+                    "register": "cat_result",
+                    "failed_when": "cat_result.stdout != 'compressed'",
+                },
+            ],
+        },
     ]
-    assert become_module_result["failed"], become_result.stdout
-    assert become_module_result["rc"] == 1, become_result.stdout
-    assert (
-        become_module_result["module_stderr"].rstrip()
-        == "sudo: a password is required"
-    ), become_result.stdout
+
+    result = run_playbook(playbook, vms=[vm.name])
+    assert result.returncode == 0, result.stdout
@@ -0,0 +1,52 @@
+import os
+
+import pytest
+from ansible.playbook.play_context import PlayContext
+
+from plugins.connection.qubes import Connection
+
+
+@pytest.fixture
+def local_connection(monkeypatch):
+    """
+    Build a connection running its commands in a local bash instead of a
+    qube, with the given plugin options.
+    """
+    play_context = PlayContext()
+    play_context.remote_addr = "localhost"
+    connection = Connection(play_context, None)
+    connection._local_cmd_bytes = [b"/bin/bash"]
+
+    def with_options(**options):
+        defaults = {
+            "persistent_session": False,
+            "batch_put": False,
+            "compress_put": False,
+        }
+        monkeypatch.setattr(
+            connection, "get_option", {**defaults, **options}.get
+        )
+        return connection
+
+    yield with_options
+    connection.close()
+
+
+def test_compress_put_fails_when_gunzip_fails(
+    local_connection, tmp_path, monkeypatch
+):
+    # A gunzip that consumes its input and fails, first in the PATH
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    gunzip = bin_dir / "gunzip"
+    gunzip.write_text("#!/bin/sh\ncat >/dev/null\nexit 1\n")
+    gunzip.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    src = tmp_path / "src"
+    src.write_bytes(b"compressed\n" * 1024)
+    dest = tmp_path / "dest"
+
+    connection = local_connection(compress_put=True)
+    with pytest.raises(RuntimeError, match="Failed to put_file"):
+        connection.put_file(str(src), str(dest))
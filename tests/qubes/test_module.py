@@ -1,8 +1,9 @@
-import os
-import time
+import uuid
+
+import pytest
 
 from plugins.modules.qubesos import core, VIRT_SUCCESS, VIRT_FAILED
-from tests.qubes.conftest import qubes, vmname, Module
+from tests.qubes.conftest import qubes, vmname, Module, wait_until
 
 
 def test_create_start_shutdown_destroy_remove(qubes, vmname, request):
@@ -25,8 +26,7 @@ def test_create_start_shutdown_destroy_remove(qubes, vmname, request):
     # Shutdown
     rc, _ = core(Module({"command": "shutdown", "name": vmname}))
     assert rc == VIRT_SUCCESS
-    time.sleep(5)
-    assert vm.is_halted()
+    assert wait_until(vm.is_halted)
 
     # Remove
     rc, _ = core(Module({"command": "remove", "name": vmname}))
@@ -52,23 +52,23 @@ def test_create_and_absent(qubes, vmname, request):
     assert vmname not in qubes.domains
 
 
-def test_pause_and_unpause(qubes, vmname, request):
-    request.node.mark_vm_created(vmname)
-    core(Module({"command": "create", "name": vmname, "vmtype": "AppVM"}))
-    core(Module({"command": "start", "name": vmname}))
-    time.sleep(1)
+def test_pause_and_unpause(vm, request):
+    # Leave the shared qube halted, even when an assertion fails
+    request.addfinalizer(
+        lambda: core(Module({"command": "destroy", "name": vm.name}))
+    )
 
-    rc, _ = core(Module({"command": "pause", "name": vmname}))
-    assert rc == VIRT_SUCCESS
-    assert qubes.domains[vmname].is_paused()
+    core(Module({"command": "start", "name": vm.name}))
+    # is_running() is already true while the domain is still Transient
+    assert wait_until(lambda: vm.get_power_state() == "Running")
 
-    rc, _ = core(Module({"command": "unpause", "name": vmname}))
+    rc, _ = core(Module({"command": "pause", "name": vm.name}))
     assert rc == VIRT_SUCCESS
-    assert qubes.domains[vmname].is_running()
+    assert vm.is_paused()
 
-    # Clean up
-    core(Module({"command": "destroy", "name": vmname}))
-    core(Module({"state": "absent", "name": vmname}))
+    rc, _ = core(Module({"command": "unpause", "name": vm.name}))
+    assert rc == VIRT_SUCCESS
+    assert vm.is_running()
 
 
 def test_status_command(qubes, vmname, request):
@@ -86,19 +86,21 @@ def test_status_command(qubes, vmname, request):
     rc, state = core(Module({"command": "status", "name": vmname}))
     assert state["status"] == "shutdown"
 
-    core(Module({"state": "absent", "name": vmname}))
 
-
-def test_list_info_and_inventory(tmp_path, qubes):
+@pytest.mark.xdist_group("global_state")
+def test_list_info_and_inventory(tmp_path, qubes, request, monkeypatch):
     # Use a temporary directory for inventory
-    os.chdir(tmp_path)
+    monkeypatch.chdir(tmp_path)
 
-    # Create a standalone VM (by default we don't have any)
+    # Create a standalone VM (by default we don't have any), uniquely named
+    # so that concurrent test runs do not collide
+    standalone = f"test-standalone-{uuid.uuid4().hex[:8]}"
+    request.node.mark_vm_created(standalone)
     core(
         Module(
             {
                 "command": "create",
-                "name": "teststandalone",
+                "name": standalone,
                 "vmtype": "StandaloneVM",
                 "template": "debian-12-xfce",
             }
@@ -110,7 +112,7 @@ def test_list_info_and_inventory(tmp_path, qubes):
     for vm in qubes.domains.values():
         if vm.name == "dom0":
             continue
-        expected.setdefault(vm.klass, []).append(vm.name)
+        expected.setdefault(vm.klass, set()).add(vm.name)
 
     # Run createinventory
     rc, res = core(Module({"command": "createinventory"}))
@@ -121,25 +123,22 @@ def test_list_info_and_inventory(tmp_path, qubes):
     assert inv_file.exists()
     lines = inv_file.read_text().splitlines()
 
-    # Helper to extract section values
-    def section(name):
-        start = lines.index(f"[{name}]") + 1
-        # find next section header
-        for i, line in enumerate(lines[start:], start=start):
-            if line.startswith("["):
-                end = i
-                break
-        else:
-            end = len(lines)
-        return [l for l in lines[start:end] if l.strip()]
+    # Index the inventory sections in a single pass
+    sections = {}
+    entries = None
+    for line in lines:
+        if line.startswith("["):
+            entries = sections.setdefault(line.strip("[]"), [])
+        elif line.strip() and entries is not None:
+            entries.append(line)
 
-    appvms = section("appvms")
-    templatevms = section("templatevms")
-    standalonevms = section("standalonevms")
+    appvms = sections["appvms"]
+    templatevms = sections["templatevms"]
+    standalonevms = sections["standalonevms"]
 
-    assert set(appvms) == set(expected.get("AppVM", []))
-    assert set(templatevms) == set(expected.get("TemplateVM", []))
-    assert set(standalonevms) == set(expected.get("StandaloneVM", []))
+    assert set(appvms) == set(expected.get("AppVM", set()))
+    assert set(templatevms) == set(expected.get("TemplateVM", set()))
+    assert set(standalonevms) == set(expected.get("StandaloneVM", set()))
 
 
 def test_properties_and_tags(qubes, vmname, request):
@@ -156,52 +155,40 @@ def test_properties_and_tags(qubes, vmname, request):
     assert rc == VIRT_SUCCESS
     changed_values = res["Properties updated"]
     assert "autostart" in changed_values
-    assert qubes.domains[vmname].autostart is True
-    for t in tags:
-        assert t in qubes.domains[vmname].tags
-    # cleanup
-    core(Module({"state": "absent", "name": vmname}))
-
-
-def test_invalid_property_key(qubes):
-    # Unknown property should fail
-    rc, res = core(
-        Module(
-            {"state": "present", "name": "dom0", "properties": {"titi": "toto"}}
-        )
-    )
-    assert rc == VIRT_FAILED
-    assert "Invalid property" in res
-
-
-def test_invalid_property_type(qubes, vmname, request):
-    # Wrong type for memory
-    rc, res = core(
-        Module(
-            {
-                "state": "present",
-                "name": vmname,
-                "properties": {"memory": "toto"},
-            }
-        )
-    )
-    assert rc == VIRT_FAILED
-    assert "Invalid property value type" in res
-
-
-def test_missing_netvm(qubes, vmname, request):
-    # netvm does not exist
+    vm = qubes.domains[vmname]
+    assert vm.autostart is True
+    assert set(tags) <= set(vm.tags)
+
+
+@pytest.mark.parametrize(
+    "properties, error",
+    [
+        ({"titi": "toto"}, "Invalid property"),
+        ({"memory": "toto"}, "Invalid property value type"),
+        ({"netvm": "toto"}, "Missing netvm"),
+        ({"default_dispvm": "toto"}, "Missing default_dispvm"),
+        ({"volume": {"name": "root", "size": 10}}, "Wrong volume name"),
+        ({"volume": {"size": 10}}, "Missing name for the volume"),
+        ({"volume": {"name": "private"}}, "Missing size for the volume"),
+    ],
+    ids=[
+        "invalid-key",
+        "invalid-type",
+        "missing-netvm",
+        "missing-default-dispvm",
+        "wrong-volume-name",
+        "missing-volume-name",
+        "missing-volume-size",
+    ],
+)
+def test_invalid_properties(qubes, vmname, properties, error):
+    # Rejected before the qube is created
     rc, res = core(
-        Module(
-            {
-                "state": "present",
-                "name": vmname,
-                "properties": {"netvm": "toto"},
-            }
-        )
+        Module({"state": "present", "name": vmname, "properties": properties})
     )
     assert rc == VIRT_FAILED
-    assert "Missing netvm" in res
+    # The error is the only key, not a substring of a message
+    assert list(res) == [error], res
 
 
 def test_default_netvm(qubes, vm, netvm, request):
@@ -241,80 +228,13 @@ def test_default_netvm(qubes, vm, netvm, request):
     assert qubes.domains[vm.name].netvm == default_netvm
 
 
-def test_missing_default_dispvm(qubes):
-    # default_dispvm does not exist
-    rc, res = core(
-        Module(
-            {
-                "state": "present",
-                "name": "dom0",
-                "properties": {"default_dispvm": "toto"},
-            }
-        )
-    )
-    assert rc == VIRT_FAILED
-    assert "Missing default_dispvm" in res
-
-
-def test_wrong_volume_name(qubes, vmname, request):
-    # volume name not allowed for AppVM
-    rc, res = core(
-        Module(
-            {
-                "state": "present",
-                "name": vmname,
-                "properties": {"volume": {"name": "root", "size": 10}},
-            }
-        )
-    )
-    assert rc == VIRT_FAILED
-    assert "Wrong volume name" in res
-
-
-def test_missing_volume_fields(qubes, vmname, request):
-    # Missing name
-    rc1, res1 = core(
-        Module(
-            {
-                "state": "present",
-                "name": vmname,
-                "properties": {"volume": {"size": 10}},
-            }
-        )
-    )
-    assert rc1 == VIRT_FAILED
-    assert "Missing name for the volume" in res1
-
-    # Missing size
-    rc2, res2 = core(
-        Module(
-            {
-                "state": "present",
-                "name": vmname,
-                "properties": {"volume": {"name": "private"}},
-            }
-        )
-    )
-    assert rc2 == VIRT_FAILED
-    assert "Missing size for the volume" in res2
-
-
-def test_removetags_without_tags(qubes, vmname, request):
-    request.node.mark_vm_created(vmname)
-
-    # Create
-    rc, _ = core(
-        Module({"command": "create", "name": vmname, "vmtype": "AppVM"})
-    )
-    assert rc == VIRT_SUCCESS
-    assert vmname in qubes.domains
-
-    # Remove tags
-    rc, res = core(Module({"command": "removetags", "name": vmname}))
+def test_removetags_without_tags(vm):
+    rc, res = core(Module({"command": "removetags", "name": vm.name}))
     assert rc == VIRT_FAILED
     assert "Missing tag" in res.get("Error", "")
 
 
+@pytest.mark.xdist_group("global_state")
 def test_pci_facts_match_actual_devices(qubes):
     # Gather PCI facts from the module
     rc, res = core(Module({"gather_device_facts": True}))
@@ -325,22 +245,16 @@ def test_pci_facts_match_actual_devices(qubes):
     assert "pci_usb" in facts
     assert "pci_audio" in facts
 
-    # Compute the lists directly from qubes.domains["dom0"]
-    net_actual = [
-        f"pci:dom0:{dev.port_id}"
-        for dev in qubes.domains["dom0"].devices["pci"]
-        if repr(dev.interfaces[0]).startswith("p02")
-    ]
-    usb_actual = [
-        f"pci:dom0:{dev.port_id}"
-        for dev in qubes.domains["dom0"].devices["pci"]
-        if repr(dev.interfaces[0]).startswith("p0c03")
-    ]
-    audio_actual = [
-        f"pci:dom0:{dev.port_id}"
-        for dev in qubes.domains["dom0"].devices["pci"]
-        if repr(dev.interfaces[0]).startswith("p0403")
-    ]
+    # Bucket dom0's PCI devices by interface class in a single pass
+    net_actual, usb_actual, audio_actual = [], [], []
+    for dev in qubes.domains["dom0"].devices["pci"]:
+        iface = repr(dev.interfaces[0])
+        if iface.startswith("p02"):
+            net_actual.append(f"pci:dom0:{dev.port_id}")
+        elif iface.startswith("p0c03"):
+            usb_actual.append(f"pci:dom0:{dev.port_id}")
+        elif iface.startswith("p0403"):
+            audio_actual.append(f"pci:dom0:{dev.port_id}")
 
     # Compare sets
     assert set(facts["pci_net"]) == set(net_actual)
@@ -348,6 +262,25 @@ def test_pci_facts_match_actual_devices(qubes):
     assert set(facts["pci_audio"]) == set(audio_actual)
 
 
+def assigned_ports(qubes, vmname):
+    """Refresh the domains once and list the qube's assigned pci and block ports"""
+    qubes.domains.refresh_cache(force=True)
+    devices = qubes.domains[vmname].devices
+    pci_ports = [
+        (
+            f"pci:dom0:{d.virtual_device.port_id}"
+            if hasattr(d, "virtual_device")
+            else d.port_id
+        )
+        for d in devices["pci"].get_assigned_devices()
+    ]
+    blk_ports = [
+        f"block:dom0:{d.device.port_id}" if hasattr(d, "device") else d.port_id
+        for d in devices["block"].get_assigned_devices()
+    ]
+    return pci_ports, blk_ports
+
+
 def test_strict_single_pci(qubes, vmname, request, latest_net_ports):
     request.node.mark_vm_created(vmname)
     port = latest_net_ports[-1]
@@ -364,21 +297,9 @@ def test_strict_single_pci(qubes, vmname, request, latest_net_ports):
     )
     assert rc == VIRT_SUCCESS
 
-    qubes.domains.refresh_cache(force=True)
-    assigned = qubes.domains[vmname].devices["pci"].get_assigned_devices()
-    ports_assigned = [
-        (
-            f"pci:dom0:{d.virtual_device.port_id}"
-            if hasattr(d, "virtual_device")
-            else d.port_id
-        )
-        for d in assigned
-    ]
+    ports_assigned, _ = assigned_ports(qubes, vmname)
     assert ports_assigned == [port]
 
-    # Clean up
-    core(Module({"state": "absent", "name": vmname}))
-
 
 def test_strict_multiple_devices_including_block(
     qubes, vmname, request, latest_net_ports, block_device
@@ -398,27 +319,10 @@ def test_strict_multiple_devices_including_block(
     )
     assert rc == VIRT_SUCCESS
 
-    qubes.domains.refresh_cache(force=True)
-    pci_assigned = qubes.domains[vmname].devices["pci"].get_assigned_devices()
-    blk_assigned = qubes.domains[vmname].devices["block"].get_assigned_devices()
-
-    pci_ports = [
-        (
-            f"pci:dom0:{d.virtual_device.port_id}"
-            if hasattr(d, "virtual_device")
-            else d.port_id
-        )
-        for d in pci_assigned
-    ]
-    blk_ports = [
-        f"block:dom0:{d.device.port_id}" if hasattr(d, "device") else d.port_id
-        for d in blk_assigned
-    ]
+    pci_ports, blk_ports = assigned_ports(qubes, vmname)
     assert set(pci_ports) == set(latest_net_ports[-2:]), "PCI ports mismatch"
     assert blk_ports == [block_device], "Block device not assigned correctly"
 
-    core(Module({"state": "absent", "name": vmname}))
-
 
 def test_append_strategy_adds_without_removing(
     qubes, vmname, request, latest_net_ports, block_device
@@ -454,26 +358,12 @@ def test_append_strategy_adds_without_removing(
     )
     assert rc == VIRT_SUCCESS
 
-    qubes.domains.refresh_cache(force=True)
-    pci_ports = [
-        (
-            f"pci:dom0:{d.virtual_device.port_id}"
-            if hasattr(d, "virtual_device")
-            else d.port_id
-        )
-        for d in qubes.domains[vmname].devices["pci"].get_assigned_devices()
-    ]
-    blk_ports = [
-        f"block:dom0:{d.device.port_id}" if hasattr(d, "device") else d.port_id
-        for d in qubes.domains[vmname].devices["block"].get_assigned_devices()
-    ]
+    pci_ports, blk_ports = assigned_ports(qubes, vmname)
 
     # All three must now be present
     assert set(pci_ports) == {first_port, second_port}
     assert blk_ports == [block_device]
 
-    core(Module({"state": "absent", "name": vmname}))
-
 
 def test_per_device_mode_and_options(qubes, vmname, request, latest_net_ports):
     request.node.mark_vm_created(vmname)
@@ -506,8 +396,6 @@ def test_per_device_mode_and_options(qubes, vmname, request, latest_net_ports):
     assert mode == "required"
     assert "no-strict-reset" in opts
 
-    core(Module({"state": "absent", "name": vmname}))
-
 
 def test_services_alias_to_features_only(qubes, vmname, request):
     request.node.mark_vm_created(vmname)
@@ -535,9 +423,6 @@ def test_services_alias_to_features_only(qubes, vmname, request):
         assert key in qube.features
         assert qube.features[key] == "1"
 
-    # cleanup
-    core(Module({"state": "absent", "name": vmname}))
-
 
 def test_services_and_explicit_features_combined(qubes, vmname, request):
     request.node.mark_vm_created(vmname)
@@ -574,9 +459,6 @@ def test_services_and_explicit_features_combined(qubes, vmname, request):
         assert key in qube.features
         assert qube.features[key] == "1"
 
-    # cleanup
-    core(Module({"state": "absent", "name": vmname}))
-
 
 def test_shutdown_with_and_without_wait(qubes, vmname, request):
     request.node.mark_vm_created(vmname)
@@ -599,8 +481,7 @@ def test_shutdown_with_and_without_wait(qubes, vmname, request):
     # vm is not halted yet
     assert not vm.is_halted()
     # allow a bit of time for actual shutdown
-    time.sleep(5)
-    assert vm.is_halted()
+    assert wait_until(vm.is_halted)
 
     # Restart for the next check
     rc, _ = core(Module({"command": "start", "name": vmname}))
@@ -612,3 +493,40 @@ def test_shutdown_with_and_without_wait(qubes, vmname, request):
     assert rc == VIRT_SUCCESS
     # should already be halted, no extra sleep needed
     assert vm.is_halted()
+
+
+def test_list_of_names(qubes, request):
+    names = [f"test-vm-{uuid.uuid4().hex[:8]}" for _ in range(2)]
+    for name in names:
+        request.node.mark_vm_created(name)
+
+    rc, res = core(Module({"state": "present", "name": names}))
+    assert rc == VIRT_SUCCESS
+    assert res["changed"]
+    assert set(res["results"]) == set(names)
+    qubes.domains.refresh_cache(force=True)
+    for name in names:
+        assert name in qubes.domains
+
+    # Running the same task again changes nothing
+    rc, res = core(Module({"state": "present", "name": names}))
+    assert rc == VIRT_SUCCESS
+    assert not res["changed"]
+
+
+@pytest.mark.parametrize(
+    "name",
+    [[], ["dom0", None], ["dom0", ["dom0"]], {"name": "dom0"}],
+    ids=["empty-list", "none-item", "list-item", "dict"],
+)
+def test_invalid_name(qubes, name):
+    rc, res = core(Module({"state": "present", "name": name}))
+    assert rc == VIRT_FAILED
+    assert list(res) == ["Invalid name"], res
+
+
+def test_command_without_name(qubes):
+    # Reported as a failed result rather than through fail_json()
+    rc, res = core(Module({"command": "start"}))
+    assert rc == VIRT_FAILED
+    assert res == {"Error": "start requires 1 argument: guest"}